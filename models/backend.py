@@ -5,11 +5,12 @@ import itertools
 from models.einsum import Graph, EinsumNetwork, ExponentialFamilyArray
 from models.hclt.clt import learn_clt
 from models.hclt.dltm import DLTM
+from utils.graphs import tril_buffers
 
 
 def permute_tril(nd_x, perms_x):
     nd_a = nd_x * (nd_x - 1) / 2
-    m = torch.tril(torch.ones(nd_x, nd_x, dtype=torch.bool), diagonal=-1)
+    m, _, _ = tril_buffers(nd_x)
     a = torch.zeros(nd_x, nd_x, dtype=torch.int)
     l = torch.arange(nd_a, dtype=torch.int)
     a[m] = l
@@ -23,7 +24,16 @@ def permute_tril(nd_x, perms_x):
 
     return perms_a
 
-class BTreeSPN(EinsumNetwork.EinsumNetwork):
+class EinsumSPN(EinsumNetwork.EinsumNetwork):
+    def forward(self, x):
+        # the leaves are summed in the log-domain, keep them in float32 under autocast
+        with torch.autocast('cuda', enabled=False):
+            self.einet_layers[0](x=x)
+        for einsum_layer in self.einet_layers[1:]:
+            einsum_layer()
+        return self.einet_layers[-1].prob[:, :, 0]
+
+class BTreeSPN(EinsumSPN):
     def __init__(self,
                  nd,
                  nk,
@@ -46,7 +56,7 @@ class BTreeSPN(EinsumNetwork.EinsumNetwork):
         super().__init__(graph, args)
         self.initialize()
 
-class VTreeSPN(EinsumNetwork.EinsumNetwork):
+class VTreeSPN(EinsumSPN):
     def __init__(self,
                  nd,
                  nk,
@@ -69,7 +79,7 @@ class VTreeSPN(EinsumNetwork.EinsumNetwork):
         super().__init__(graph, args)
         self.initialize()
 
-class RTreeSPN(EinsumNetwork.EinsumNetwork):
+class RTreeSPN(EinsumSPN):
     def __init__(self,
                  nd,
                  nk,
@@ -93,7 +103,7 @@ class RTreeSPN(EinsumNetwork.EinsumNetwork):
         super().__init__(graph, args)
         self.initialize()
 
-class PTreeSPN(EinsumNetwork.EinsumNetwork):
+class PTreeSPN(EinsumSPN):
     def __init__(self,
                  nd,
                  nk,
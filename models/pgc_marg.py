@@ -2,17 +2,28 @@ import torch
 import torch.nn as nn
 
 from models.backend import backend_selector
+from utils.graphs import tril_buffers, unflatt_tril
 from typing import Optional
 
 
+def _cat_sample(logits: torch.Tensor, num_samples: int=1):
+    return torch.multinomial(logits.softmax(-1), num_samples, replacement=True).squeeze(-1)
+
+def _cdf_sample(logits: torch.Tensor):
+    cdf = logits.softmax(-1).cumsum(-1)
+    u = torch.rand(*cdf.shape[:-1], 1, device=cdf.device)
+    return torch.searchsorted(cdf, u, right=True).squeeze(-1).clamp_(max=cdf.size(-1)-1)
+
+
 class PGCMargSort(nn.Module):
     def __init__(self,
                  loader_trn,
                  hpars
                  ):
         super().__init__()
-        x = torch.stack([b['x'] for b in loader_trn.dataset])
-        a = torch.stack([b['a'] for b in loader_trn.dataset])
+        b = next(iter(torch.utils.data.DataLoader(loader_trn.dataset, batch_size=len(loader_trn.dataset), generator=torch.Generator())))
+        x = b['x']
+        a = b['a']
 
         network_x, nd_x, nk_x, network_a, nd_a, nk_a = backend_selector(x, a, hpars, nk_x_offset=True)
 
@@ -23,20 +34,35 @@ class PGCMargSort(nn.Module):
 
         self.nc = hpars['nc']
         self.device = hpars['device']
+        self.autocast = hpars.get('autocast', False)
 
         self.network_x = network_x
         self.network_a = network_a
 
         self.logits_n = nn.Parameter(torch.randn(nd_x,    device=self.device), requires_grad=True)
         self.logits_w = nn.Parameter(torch.randn(self.nc, device=self.device), requires_grad=True)
-        self.m = torch.tril(torch.ones(nd_x, nd_x, dtype=torch.bool, device=self.device), diagonal=-1)
+        self._register_index_buffers(self.device)
 
         self.to(self.device)
 
-    def forward(self, x: torch.Tensor, a: torch.Tensor):
-        x -= 1
+    def _register_index_buffers(self, device):
+        _, tril_r, tril_c = tril_buffers(self.nd_x, device)
+        self.register_buffer('tril_r', tril_r.clone(), persistent=False)
+        self.register_buffer('tril_c', tril_c.clone(), persistent=False)
+        self.register_buffer('arange_nd', torch.arange(self.nd_x, device=device), persistent=False)
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.__dict__.setdefault('autocast', False)
+        # models pickled before the index buffers were introduced only carry the boolean mask 'm'
+        if 'tril_r' not in self._buffers:
+            self.__dict__.pop('m', None)
+            self._register_index_buffers(self.logits_n.device)
+
+    def forward(self, x: torch.Tensor, l: torch.Tensor):
+        x = x - 1
         mask_xn = (x > -1)
-        mask_an = (mask_xn.unsqueeze(2) * mask_xn.unsqueeze(1))[:, self.m].view(-1, self.nd_a)
+        mask_an = mask_xn[:, self.tril_r].logical_and_(mask_xn[:, self.tril_c])
         self.network_x.set_marginalization_mask(mask_xn)
         self.network_a.set_marginalization_mask(mask_an)
 
@@ -44,14 +70,19 @@ class PGCMargSort(nn.Module):
         dist_n = torch.distributions.Categorical(logits=self.logits_n)
 
         logs_c = dist_n.log_prob(n)
-        logs_x = self.network_x(x)
-        logs_a = self.network_a(a[:, self.m].view(-1, self.nd_a))
+        # with autocast, only the prob-domain contractions (einsum/mixing layers, DLTM bmm) run in bfloat16
+        with torch.autocast('cuda', dtype=torch.bfloat16, enabled=self.autocast and torch.device(self.device).type == 'cuda'):
+            logs_x = self.network_x(x)
+            logs_a = self.network_a(l)
+        logs_x = logs_x.float()
+        logs_a = logs_a.float()
+
         logs_w = torch.log_softmax(self.logits_w, dim=0).unsqueeze(0)
 
         return logs_c + torch.logsumexp(logs_x + logs_a + logs_w, dim=1)
 
-    def logpdf(self, x, a):
-        return self(x, a).mean()
+    def logpdf(self, x, l):
+        return self(x, l).mean()
 
     @torch.no_grad
     def _sample(self, num_samples: int=1, cond_x: Optional[torch.Tensor]=None, cond_a: Optional[torch.Tensor]=None):
@@ -75,8 +106,8 @@ class PGCMargSort(nn.Module):
 
         if cond_a is not None:
             mask_a = (cond_a > -1)
-            mask_a = mask_a[:, self.m].view(-1, self.nd_a)
-            cond_a = cond_a[:, self.m].view(-1, self.nd_a)
+            mask_a = mask_a[:, self.tril_r, self.tril_c]
+            cond_a = cond_a[:, self.tril_r, self.tril_c]
 
             self.network_a.set_marginalization_mask(mask_a)
             logs_a = self.network_a(cond_a)
@@ -86,57 +117,53 @@ class PGCMargSort(nn.Module):
 
         logs_w = logs_x + logs_a + self.logits_w.unsqueeze(0)
 
-        samp_n = torch.distributions.Categorical(logits=logs_n).sample()
-        samp_w = torch.distributions.Categorical(logits=logs_w).sample()
+        samp_n = _cat_sample(logs_n)
+        samp_w = _cdf_sample(logs_w)
 
-        mask_xn = torch.arange(self.nd_x, device=self.device).unsqueeze(0) <= samp_n.unsqueeze(1)
-        mask_an = (mask_xn.unsqueeze(2) * mask_xn.unsqueeze(1))[:, self.m].view(-1, self.nd_a)
-        mask_xx = mask_x + mask_xn
-        mask_aa = mask_a + mask_an
+        mask_xn = self.arange_nd.unsqueeze(0) <= samp_n.unsqueeze(1)
+        mask_an = mask_xn[:, self.tril_r].logical_and_(mask_xn[:, self.tril_c])
 
         x = self.network_x.sample(num_samples, class_idxs=samp_w, x=cond_x)
         l = self.network_a.sample(num_samples, class_idxs=samp_w, x=cond_a)
 
-        x[~mask_xx] = -1
-        l[~mask_aa] = 0
+        # mask_x and mask_a are the evidence masks of the networks, update them only after sampling
+        mask_x.logical_or_(mask_xn)
+        mask_a.logical_or_(mask_an)
 
-        a = torch.zeros((num_samples, self.nd_x, self.nd_x), device=self.device)
-        a[:, self.m] = l
-        a.transpose(1, 2)[:, self.m] = l
+        x.masked_fill_(~mask_x, -1)
+        l.masked_fill_(~mask_a, 0)
 
         x += 1
 
-        return x.to(device='cpu', dtype=torch.int), a.to(device='cpu', dtype=torch.int)
+        return x.to(dtype=torch.int), l.to(dtype=torch.int)
 
     @torch.no_grad
     def sample(self, num_samples: int=1, cond_x: Optional[torch.Tensor]=None, cond_a: Optional[torch.Tensor]=None, chunk_size: int=2000):
-        x_sam = []
-        a_sam = []
-
         if cond_x is not None and cond_a is not None:
             if len(cond_x) == len(cond_a):
-                if len(cond_x) > chunk_size:
-                    for chunk_cond_x, chunk_cond_a in zip(cond_x.chunk(chunk_size), cond_a.chunk(chunk_size)):
-                        x, a = self._sample(cond_x=chunk_cond_x, cond_a=chunk_cond_a)
-                        x_sam.append(x)
-                        a_sam.append(a)
-                    x_sam, a_sam = torch.cat(x_sam), torch.cat(a_sam)
-                else:
-                    x_sam, a_sam = self._sample(cond_x=cond_x, cond_a=cond_a)
+                num_samples = len(cond_x)
+                chunks = [{'cond_x': chunk_cond_x, 'cond_a': chunk_cond_a} for chunk_cond_x, chunk_cond_a in zip(cond_x.split(chunk_size), cond_a.split(chunk_size))]
             else:
                 raise 'len(cond_x) and len(cond_a) are not equal.'
         else:
-            if num_samples > chunk_size:
-                chunks = num_samples // chunk_size*[chunk_size] + ([num_samples % chunk_size] if num_samples % chunk_size > 0 else [])
-                for n in chunks:
-                    x, a = self._sample(n)
-                    x_sam.append(x)
-                    a_sam.append(a)
-                x_sam, a_sam = torch.cat(x_sam), torch.cat(a_sam)
-            else:
-                x_sam, a_sam = self._sample(num_samples)  
+            chunks = [{'num_samples': min(chunk_size, num_samples - i)} for i in range(0, num_samples, chunk_size)]
+
+        pin_memory = torch.device(self.device).type == 'cuda'
+        x_sam = torch.empty((num_samples, self.nd_x), dtype=torch.int, pin_memory=pin_memory)
+        l_sam = torch.empty((num_samples, self.nd_a), dtype=torch.int, pin_memory=pin_memory)
+
+        start = 0
+        for chunk in chunks:
+            x, l = self._sample(**chunk)
+            end = start + len(x)
+            x_sam[start:end].copy_(x, non_blocking=True)
+            l_sam[start:end].copy_(l, non_blocking=True)
+            start = end
+
+        if pin_memory:
+            torch.cuda.current_stream().synchronize()
 
-        return x_sam, a_sam
+        return x_sam, unflatt_tril(l_sam, self.nd_x)
 
 
 MODELS = {
@@ -28,12 +28,23 @@ if __name__ == '__main__':
         'marg_sort_ctree'
     ]
 
+    loaders_cache = {}
+
     for backend in backends:
         with open(f'config/{dataset}/{backend}.json', 'r') as f:
             hyperpars = json.load(f)
         hyperpars['atom_list'] = MOLECULAR_DATASETS[dataset]['atom_list']
 
-        loaders = load_dataset(dataset, hyperpars['batch_size'], [0.8, 0.1, 0.1], order=hyperpars['order'])
+        # load_dataset reseeds the RNGs, so restore the state it left behind to initialize each model as if it had been called
+        key = (hyperpars['batch_size'], hyperpars['order'])
+        if key not in loaders_cache:
+            loaders = load_dataset(dataset, hyperpars['batch_size'], [0.8, 0.1, 0.1], order=hyperpars['order'])
+            rng_state = (torch.get_rng_state(), torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None)
+            loaders_cache[key] = (loaders, rng_state)
+        loaders, (rng_state_cpu, rng_state_cuda) = loaders_cache[key]
+        torch.set_rng_state(rng_state_cpu)
+        if rng_state_cuda is not None:
+            torch.cuda.set_rng_state_all(rng_state_cuda)
 
         model = MODELS[hyperpars['model']](loaders['loader_trn'], hyperpars['model_hpars'])
         print(dataset)
@@ -213,15 +213,15 @@ class DictDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.data)
 
-def load_dataset(name, batch_size, split, seed=0, dir='data/', order='canonical'):
+def load_dataset(name, batch_size, split, seed=0, dir='data/', order='canonical', num_workers=2):
     x = DictDataset(torch.load(f'{dir}{name}_{order}.pt', weights_only=True))
 
     torch.manual_seed(seed)
     x_trn, x_val, x_tst = torch.utils.data.random_split(x, split)
 
-    loader_trn = torch.utils.data.DataLoader(x_trn, batch_size=batch_size, num_workers=2, shuffle=False, pin_memory=True)
-    loader_val = torch.utils.data.DataLoader(x_val, batch_size=batch_size, num_workers=2, shuffle=False, pin_memory=True)
-    loader_tst = torch.utils.data.DataLoader(x_tst, batch_size=batch_size, num_workers=2, shuffle=False, pin_memory=True)
+    loader_trn = torch.utils.data.DataLoader(x_trn, batch_size=batch_size, num_workers=num_workers, shuffle=False, pin_memory=True, persistent_workers=num_workers > 0)
+    loader_val = torch.utils.data.DataLoader(x_val, batch_size=batch_size, num_workers=num_workers, shuffle=False, pin_memory=True, persistent_workers=num_workers > 0)
+    loader_tst = torch.utils.data.DataLoader(x_tst, batch_size=batch_size, num_workers=num_workers, shuffle=False, pin_memory=True, persistent_workers=num_workers > 0)
 
     smiles_trn = [x['s'] for x in loader_trn.dataset]
     smiles_val = [x['s'] for x in loader_val.dataset]
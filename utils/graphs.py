@@ -1,4 +1,5 @@
 import torch
+import functools
 
 def permute_graph(xx, aa, pi):
     px = xx[pi, ...]
@@ -40,13 +41,22 @@ def unflatt_band(a_flat):
             a[i+1:i+1+m, i] = a_flat[i, :m]
     return a
 
+@functools.lru_cache(maxsize=32)
+def tril_buffers(nd, device='cpu'):
+    """Strict lower-triangular mask and its row/column indices, cached per (nd, device).
+       The returned tensors are shared by all callers and must not be modified in place."""
+    r, c = torch.tril_indices(nd, nd, offset=-1, device=device)
+    m = torch.zeros(nd, nd, dtype=torch.bool, device=device)
+    m[r, c] = True
+    return m, r, c
+
 def flatten_tril(a, max_atom):
-    m = torch.tril(torch.ones(max_atom, max_atom, dtype=torch.bool), diagonal=-1)
+    m, _, _ = tril_buffers(max_atom)
     return a[..., m].reshape(-1)
 
 def unflatt_tril(l, max_atom):
-    m = torch.tril(torch.ones(max_atom, max_atom, dtype=torch.bool), diagonal=-1)
+    _, r, c = tril_buffers(max_atom)
     a = torch.zeros(*l.shape[:-1], max_atom, max_atom).type_as(l)
-    a[..., m] = l
-    a.transpose(1, 2)[..., m] = l
+    a[..., r, c] = l
+    a[..., c, r] = l
     return a
@@ -6,7 +6,6 @@ import pandas as pd
 from tqdm import tqdm
 from timeit import default_timer
 from rdkit.Chem.Draw import MolsToGridImage
-from utils.graphs import unflatt_tril
 
 from utils.evaluate import evaluate_molecules, resample_invalid_mols, count_parameters, print_metrics
 from utils.molecular import correct_mols, mols2gs
@@ -44,10 +43,9 @@ def backend_hpars_prefix(d):
 def run_epoch(model, loader, optimizer=[], verbose=False):
     nll_sum = 0.
     for b in tqdm(loader, leave=False, disable=verbose):
-        x = b['x'].to(model.device)
-        a = b['a'].to(model.device)
-        a = unflatt_tril(a, x.size(1))
-        nll = -model.logpdf(x, a)
+        x = b['x'].to(model.device, non_blocking=True)
+        l = b['a'].to(model.device, non_blocking=True)
+        nll = -model.logpdf(x, l)
         nll_sum += nll
         if optimizer:
             optimizer.zero_grad()